@@ -10,60 +10,34 @@ Usage:
     python excel.py --excel-file <path_to_excel_file> --column <link_column_name>
 
 Requirements:
-    - Python 3.7+
-    - pip install pandas openpyxl requests supabase python-dotenv tqdm
+    - Python 3.9+
+    - pip install pandas openpyxl aiohttp aiofiles orjson python-dotenv tqdm
 """
 
 import os
 import sys
 import argparse
+import asyncio
 import uuid
+import shutil
 import tempfile
+import contextlib
+import itertools
 from pathlib import Path
 import mimetypes
 import json
+import base64
+import hashlib
 from datetime import datetime
-
-# Try to import required packages, install if missing
-required_packages = {
-    'pandas': 'pandas',
-    'requests': 'requests',
-    'tqdm': 'tqdm',
-    'python-dotenv': 'dotenv',
-    'supabase': 'supabase'
-}
-
-missing_packages = []
-
-for package, module in required_packages.items():
-    try:
-        __import__(module)
-    except ImportError:
-        missing_packages.append(package)
-
-if missing_packages:
-    print(f"Installing missing packages: {' '.join(missing_packages)}")
-    try:
-        import subprocess
-        subprocess.check_call([sys.executable, "-m", "pip", "install"] + missing_packages)
-        print("Successfully installed missing packages")
-        
-        # Try importing again
-        for package, module in required_packages.items():
-            if package in missing_packages:
-                try:
-                    __import__(module)
-                except ImportError as e:
-                    print(f"Error: Failed to import {module} after installation: {e}")
-                    sys.exit(1)
-    except Exception as e:
-        print(f"Error installing packages: {e}")
-        print("Please install them manually using pip:")
-        print(f"pip install {' '.join(missing_packages)}")
-        sys.exit(1)
+from urllib.parse import urljoin
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
-import requests
+from openpyxl import load_workbook
+import aiohttp
+import aiofiles
+import orjson
 from tqdm import tqdm
 from dotenv import load_dotenv
 # Load environment variables from .env.local
@@ -81,45 +55,307 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 print(f"Using Supabase URL: {SUPABASE_URL}")
 print(f"Supabase key exists: {bool(SUPABASE_KEY)}")
 
+# Number of documents downloaded at the same time
+DOWNLOAD_WORKERS = 8
+
+# Number of documents uploaded at the same time
+UPLOAD_WORKERS = 4
+
+# Maximum number of rows/downloaded files waiting in each queue; keeps
+# memory and temporary disk usage bounded when one side falls behind
+QUEUE_SIZE = 8
+
+# Threads for the blocking work handed off by the pipeline (reading the
+# spreadsheet, hashing and writing files), so the event loop keeps moving
+IO_THREADS = 16
+
+# Spreadsheet rows parsed per trip to the thread pool
+ROW_BATCH_SIZE = 256
+
+# Maximum number of open connections shared by all requests
+CONNECTION_LIMIT = 16
+
+# Seconds to wait for a connection, and for more data on an open one. There is
+# no limit on a whole request, since large files can take a long time.
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 120
+
+# Transient gateway errors are retried with exponential backoff
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = {502, 503, 504}
+
+# Files larger than this are downloaded as parallel byte ranges
+RANGE_DOWNLOAD_THRESHOLD = 16 * 1024 * 1024
+
+# Number of byte ranges a large download is split into
+RANGE_DOWNLOAD_PARTS = 8
+
+# Number of document records inserted into the database per request
+INSERT_BATCH_SIZE = 50
+
+# Size of the chunks streamed from disk when uploading a file
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Files larger than this are uploaded with the resumable (TUS) protocol so
+# a dropped connection only costs the current chunk
+RESUMABLE_UPLOAD_THRESHOLD = 6 * 1024 * 1024
+
+# Supabase requires every resumable chunk except the last to be exactly 6 MB
+RESUMABLE_CHUNK_SIZE = 6 * 1024 * 1024
+
+def create_session():
+    """Create the HTTP session shared by every download and upload.
+    
+    Reusing one session keeps connections alive between requests, so the
+    TCP and TLS handshakes are paid once per host rather than once per file.
+    """
+    connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+@contextlib.asynccontextmanager
+async def request_with_retry(session, method, url, **kwargs):
+    """Send an idempotent request, retrying connection, timeout and gateway errors."""
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        try:
+            response = await session.request(method, url, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == RETRY_ATTEMPTS:
+                raise
+        else:
+            if response.status not in RETRY_STATUSES or attempt == RETRY_ATTEMPTS:
+                break
+            response.release()
+        
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+    
+    try:
+        yield response
+    finally:
+        response.release()
+
 # Supabase API helper functions
-def supabase_upload_file(bucket, path, file_content, content_type=None):
+async def supabase_upload_file(session, bucket, path, file_content, content_type=None, content_length=None):
     """Upload a file to Supabase Storage using direct API calls."""
+    if content_length is not None and content_length > RESUMABLE_UPLOAD_THRESHOLD:
+        return await supabase_upload_file_resumable(
+            session, bucket, path, file_content, content_type, content_length
+        )
+    
     headers = {
         'Authorization': f'Bearer {SUPABASE_KEY}',
-        'apikey': SUPABASE_KEY
+        'apikey': SUPABASE_KEY,
+        'x-upsert': 'true'
     }
     
     if content_type:
         headers['Content-Type'] = content_type
     
+    # Streamed bodies are sent chunked unless the length is known up front
+    if content_length is not None:
+        headers['Content-Length'] = str(content_length)
+    
     url = f"{SUPABASE_URL}/storage/v1/object/{bucket}/{path}"
     
-    response = requests.post(url, headers=headers, data=file_content)
+    async with session.post(url, headers=headers, data=file_content) as response:
+        if response.status != 200:
+            print(f"Error uploading file: {response.status} - {await response.text()}")
+            return None
+        
+        return await response.json()
+
+async def supabase_upload_file_resumable(session, bucket, path, file_content, content_type, content_length):
+    """Upload a large file to Supabase Storage with the resumable (TUS) protocol."""
+    headers = {
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'apikey': SUPABASE_KEY,
+        'Tus-Resumable': '1.0.0'
+    }
+    
+    upload_metadata = {
+        'bucketName': bucket,
+        'objectName': path,
+        'contentType': content_type or 'application/octet-stream',
+    }
+    create_headers = {
+        **headers,
+        'Upload-Length': str(content_length),
+        'Upload-Metadata': ','.join(
+            f"{key} {base64.b64encode(value.encode()).decode()}" for key, value in upload_metadata.items()
+        ),
+        'x-upsert': 'true'
+    }
+    
+    url = f"{SUPABASE_URL}/storage/v1/upload/resumable"
     
-    if response.status_code != 200:
-        print(f"Error uploading file: {response.status_code} - {response.text}")
-        return None
+    async with session.post(url, headers=create_headers) as response:
+        if response.status != 201:
+            print(f"Error creating resumable upload: {response.status} - {await response.text()}")
+            return None
+        
+        upload_url = urljoin(url, response.headers['Location'])
+    
+    offset = 0
+    async for chunk in _rechunk(file_content, RESUMABLE_CHUNK_SIZE):
+        offset = await _upload_resumable_chunk(session, upload_url, headers, chunk, offset)
+        if offset is None:
+            return None
+    
+    return {'Key': f"{bucket}/{path}"}
+
+async def _rechunk(chunks, size):
+    """Regroup an async iterator of byte chunks into chunks of exactly `size` bytes (the last may be shorter)."""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    
+    if buffer:
+        yield bytes(buffer)
+
+async def _upload_resumable_chunk(session, upload_url, headers, chunk, offset):
+    """Send one chunk of a resumable upload, resuming where the server left off after a failure.
+    
+    Returns the new upload offset, or None if the chunk could not be sent.
+    """
+    chunk_start = offset
+    
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        patch_headers = {
+            **headers,
+            'Upload-Offset': str(offset),
+            'Content-Type': 'application/offset+octet-stream'
+        }
+        
+        try:
+            async with session.patch(upload_url, headers=patch_headers, data=chunk[offset - chunk_start:]) as response:
+                if response.status == 204:
+                    return int(response.headers['Upload-Offset'])
+                
+                print(f"Error uploading chunk at offset {offset}: {response.status} - {await response.text()}")
+        except aiohttp.ClientError as e:
+            print(f"Error uploading chunk at offset {offset}: {str(e)}")
+        
+        if attempt == RETRY_ATTEMPTS:
+            break
+        
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+        
+        # Ask the server how much of the chunk arrived and send only the rest
+        async with request_with_retry(session, 'HEAD', upload_url, headers=headers) as response:
+            if response.status != 200:
+                break
+            
+            offset = int(response.headers['Upload-Offset'])
+            if offset >= chunk_start + len(chunk):
+                return offset
+    
+    return None
+
+async def supabase_delete_file(session, bucket, path):
+    """Delete a file from Supabase Storage."""
+    headers = {
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'apikey': SUPABASE_KEY
+    }
+    
+    url = f"{SUPABASE_URL}/storage/v1/object/{bucket}/{path}"
     
-    return response.json()
+    try:
+        async with session.delete(url, headers=headers) as response:
+            if response.status != 200:
+                print(f"Error deleting file: {response.status} - {await response.text()}")
+                return False
+            
+            return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error deleting file: {str(e)}")
+        return False
+
+def _json_default(obj):
+    """Encode spreadsheet values orjson doesn't support, such as pandas Timestamps."""
+    if obj is pd.NaT:
+        return None
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    return str(obj)
 
-def supabase_insert_record(table, record):
-    """Insert a record into a Supabase table using direct API calls."""
+async def supabase_insert_records(session, table, records):
+    """Insert several records into a Supabase table with a single API call."""
     headers = {
         'Authorization': f'Bearer {SUPABASE_KEY}',
         'apikey': SUPABASE_KEY,
         'Content-Type': 'application/json',
-        'Prefer': 'return=representation'
+        'Prefer': 'return=minimal'
     }
     
     url = f"{SUPABASE_URL}/rest/v1/{table}"
     
-    response = requests.post(url, headers=headers, json=record)
+    # PostgREST inserts every element of a JSON array in one statement.
+    # orjson encodes the whole batch straight to bytes, and writes NaN
+    # cells from the spreadsheet as null rather than invalid JSON.
+    body = orjson.dumps(records, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    
+    try:
+        async with session.post(url, headers=headers, data=body) as response:
+            if response.status != 201:
+                print(f"Error inserting records: {response.status} - {await response.text()}")
+                return False
+            
+            return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error inserting records: {str(e)}")
+        return False
+
+async def supabase_find_record(session, table, filters, select='*'):
+    """Return the first record of a Supabase table matching the filters, or None."""
+    headers = {
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'apikey': SUPABASE_KEY
+    }
+    
+    url = f"{SUPABASE_URL}/rest/v1/{table}"
+    params = {**filters, 'select': select, 'limit': '1'}
     
-    if response.status_code != 201:
-        print(f"Error inserting record: {response.status_code} - {response.text}")
+    try:
+        async with request_with_retry(session, 'GET', url, headers=headers, params=params) as response:
+            if response.status != 200:
+                print(f"Error querying {table}: {response.status} - {await response.text()}")
+                return None
+            
+            records = await response.json()
+            return records[0] if records else None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error querying {table}: {str(e)}")
         return None
+
+async def supabase_count_records(session, table, filters):
+    """Count the records of a Supabase table matching the filters without fetching them."""
+    headers = {
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'apikey': SUPABASE_KEY,
+        'Prefer': 'count=exact'
+    }
+    
+    url = f"{SUPABASE_URL}/rest/v1/{table}"
+    params = {**filters, 'select': 'id', 'limit': '1'}
     
-    return response.json()
+    # A HEAD request returns the count in the Content-Range header
+    # (e.g. "0-0/3" or "*/0") with no response body
+    try:
+        async with request_with_retry(session, 'HEAD', url, headers=headers, params=params) as response:
+            content_range = response.headers.get('Content-Range', '')
+            if response.status not in (200, 206) or '/' not in content_range:
+                print(f"Error counting {table}: {response.status}")
+                return None
+            
+            return int(content_range.split('/')[-1])
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error counting {table}: {str(e)}")
+        return None
 
 def parse_arguments():
     """Parse command line arguments."""
@@ -131,12 +367,21 @@ def parse_arguments():
     parser.add_argument('--type-column', help='Column name containing document types (optional)')
     parser.add_argument('--author-column', help='Column name containing document authors (optional)')
     parser.add_argument('--date-column', help='Column name containing document dates (optional)')
+    parser.add_argument('--cache-file', default='etag_cache.json',
+                        help='File used to remember downloaded URLs between runs (default: etag_cache.json)')
     return parser.parse_args()
 
-def download_file(url, temp_dir):
-    """Download a file from a URL to a temporary directory."""
+async def download_file(session, url, temp_dir, cache_entry=None, metadata=None):
+    """Download a file from a URL to a temporary directory.
+    
+    Returns a dict describing the download, ``{'not_modified': True}`` when
+    the server confirms the cached copy is still current, or None on error.
+    Files whose size is known up front are piped straight into Supabase
+    storage instead, and the dict then carries the uploaded ``record``.
+    """
     try:
         # Convert Google Drive sharing links to direct download links
+        is_google_drive = 'drive.google.com' in url
         if 'drive.google.com/file/d/' in url:
             file_id = url.split('/file/d/')[1].split('/')[0].split('?')[0]
             url = f"https://drive.google.com/uc?export=download&id={file_id}"
@@ -145,63 +390,265 @@ def download_file(url, temp_dir):
             url = f"https://drive.google.com/uc?export=download&id={file_id}"
         
         print(f"Downloading from URL: {url}")
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
         
-        # Try to get filename from Content-Disposition header
-        content_disposition = response.headers.get('Content-Disposition')
-        if content_disposition and 'filename=' in content_disposition:
-            filename = content_disposition.split('filename=')[1].strip('"\'')
-        else:
-            # Use the last part of the URL as filename
-            filename = url.split('/')[-1].split('?')[0]
+        # Ask the server to skip the body if the file hasn't changed since
+        # it was last uploaded
+        conditional_headers = {}
+        if cache_entry:
+            if cache_entry.get('etag'):
+                conditional_headers['If-None-Match'] = cache_entry['etag']
+            if cache_entry.get('last_modified'):
+                conditional_headers['If-Modified-Since'] = cache_entry['last_modified']
+        
+        # Large files are fetched as parallel byte ranges when the server
+        # supports it. Google Drive links redirect dynamically, so skip them.
+        if not is_google_drive:
+            async with request_with_retry(session, 'HEAD', url, headers=conditional_headers, allow_redirects=True) as head:
+                if head.status == 304:
+                    return {'not_modified': True}
+                
+                total_size = int(head.headers.get('Content-Length', 0))
+                if (head.status == 200
+                        and head.headers.get('Accept-Ranges') == 'bytes'
+                        and total_size > RANGE_DOWNLOAD_THRESHOLD):
+                    filename = get_download_filename(head, url)
+                    ranged = await download_file_ranges(
+                        session, str(head.url), filename, total_size, temp_dir
+                    )
+                    
+                    # Otherwise fall back to the single GET below
+                    if ranged:
+                        temp_file_path, filename = ranged
+                        
+                        # Parts arrive out of order, so hash the joined file afterwards
+                        sha256 = await asyncio.to_thread(hash_file, temp_file_path)
+                        return _download_result(head, temp_file_path, filename, total_size, sha256)
+        
+        async with request_with_retry(session, 'GET', url, headers=conditional_headers) as response:
+            if response.status == 304:
+                return {'not_modified': True}
             
-            # If no extension, try to determine from content-type
-            if '.' not in filename:
-                content_type = response.headers.get('Content-Type', '')
-                ext = mimetypes.guess_extension(content_type)
-                if ext:
-                    filename += ext
-        
-        # Create a temporary file
-        temp_file_path = os.path.join(temp_dir, filename)
-        
-        # Download the file with progress bar
-        total_size = int(response.headers.get('content-length', 0))
-        with open(temp_file_path, 'wb') as f, tqdm(
+            response.raise_for_status()
+            
+            # With a known (and undecoded) length the body can go straight to
+            # storage; otherwise stage it on disk so its size can be measured
+            if response.content_length is not None and 'Content-Encoding' not in response.headers:
+                filename = get_download_filename(response, url)
+                hasher = hashlib.sha256()
+                record = await upload_to_supabase(
+                    session,
+                    stream_response(response, filename, hasher),
+                    filename,
+                    response.content_length,
+                    metadata
+                )
+                
+                # The hash is only known once the upload has finished, so
+                # duplicates are caught (and removed) afterwards
+                sha256 = hasher.hexdigest()
+                if record:
+                    record['metadata']['sha256'] = sha256
+                
+                return {
+                    **_download_result(response, None, filename, response.content_length, sha256),
+                    'record': record,
+                }
+            
+            temp_file_path, filename, size, sha256 = await _save_response(response, url, temp_dir)
+            return _download_result(response, temp_file_path, filename, size, sha256)
+    except Exception as e:
+        print(f"Error downloading {url}: {str(e)}")
+        return None
+
+def _download_result(response, temp_file_path, filename, size, sha256):
+    """Describe a finished download, keeping its cache validators."""
+    return {
+        'path': temp_file_path,
+        'filename': filename,
+        'size': size,
+        'sha256': sha256,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+
+def get_download_filename(response, url):
+    """Work out the filename of a download from its response headers or URL."""
+    # Try to get filename from Content-Disposition header
+    content_disposition = response.headers.get('Content-Disposition')
+    if content_disposition and 'filename=' in content_disposition:
+        filename = content_disposition.split('filename=')[1].strip('"\'')
+    else:
+        # Use the last part of the URL as filename
+        filename = url.split('/')[-1].split('?')[0]
+        
+        # If no extension, try to determine from content-type
+        if '.' not in filename:
+            content_type = response.headers.get('Content-Type', '')
+            ext = mimetypes.guess_extension(content_type)
+            if ext:
+                filename += ext
+    
+    return filename
+
+def _make_temp_file_path(temp_dir, filename):
+    """Return a path for a download inside its own temporary subdirectory."""
+    # Downloads run concurrently, so give each one its own directory to
+    # avoid two documents with the same filename overwriting each other
+    return os.path.join(tempfile.mkdtemp(dir=temp_dir), filename)
+
+async def _save_response(response, url, temp_dir):
+    """Write a download response body to its own file inside the temporary directory."""
+    filename = get_download_filename(response, url)
+    temp_file_path = _make_temp_file_path(temp_dir, filename)
+    
+    # Download the file with progress bar, counting and hashing the bytes
+    # written so the file doesn't have to be read back from disk
+    total_size = int(response.headers.get('content-length', 0))
+    size = 0
+    hasher = hashlib.sha256()
+    async with aiofiles.open(temp_file_path, 'wb') as f:
+        with tqdm(
             desc=filename,
             total=total_size,
             unit='B',
             unit_scale=True,
             unit_divisor=1024,
         ) as bar:
-            for chunk in response.iter_content(chunk_size=8192):
-                size = f.write(chunk)
-                bar.update(size)
+            async for chunk in response.content.iter_chunked(8192):
+                written = await f.write(chunk)
+                bar.update(written)
+                size += written
+                hasher.update(chunk)
+    
+    return temp_file_path, filename, size, hasher.hexdigest()
+
+async def stream_response(response, filename, hasher):
+    """Yield a response body in chunks while showing progress and hashing it."""
+    with tqdm(
+        desc=filename,
+        total=response.content_length,
+        unit='B',
+        unit_scale=True,
+        unit_divisor=1024,
+    ) as bar:
+        async for chunk in response.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+            bar.update(len(chunk))
+            hasher.update(chunk)
+            yield chunk
+
+async def download_file_ranges(session, url, filename, total_size, temp_dir):
+    """Download a large file as parallel byte ranges written into one file.
+    
+    Returns None if the server ignores a range request, so the caller can
+    fall back to a single download.
+    """
+    temp_file_path = _make_temp_file_path(temp_dir, filename)
+    
+    # Pre-size the file so every part can be written straight to its offset,
+    # which avoids joining separate part files afterwards
+    await asyncio.to_thread(_allocate_file, temp_file_path, total_size)
+    
+    part_size = -(-total_size // RANGE_DOWNLOAD_PARTS)
+    
+    with tqdm(
+        desc=filename,
+        total=total_size,
+        unit='B',
+        unit_scale=True,
+        unit_divisor=1024,
+    ) as bar:
+        async def download_part(start):
+            end = min(start + part_size, total_size) - 1
+            headers = {'Range': f'bytes={start}-{end}'}
+            async with request_with_retry(session, 'GET', url, headers=headers) as response:
+                if response.status != 206:
+                    return False
+                
+                async with aiofiles.open(temp_file_path, 'r+b') as f:
+                    await f.seek(start)
+                    async for chunk in response.content.iter_chunked(8192):
+                        size = await f.write(chunk)
+                        bar.update(size)
+            
+            return True
         
-        return temp_file_path, filename
-    except Exception as e:
-        print(f"Error downloading {url}: {str(e)}")
-        return None, None
+        honoured = await asyncio.gather(*(
+            download_part(start) for start in range(0, total_size, part_size)
+        ))
+    
+    if not all(honoured):
+        print(f"Range requests for {filename} not honoured, downloading it in one piece")
+        await asyncio.to_thread(shutil.rmtree, os.path.dirname(temp_file_path), ignore_errors=True)
+        return None
+    
+    return temp_file_path, filename
+
+def _allocate_file(file_path, size):
+    """Create a file of the given size for the range parts to be written into."""
+    with open(file_path, 'wb') as f:
+        f.truncate(size)
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file."""
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+async def read_file_chunks(file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Yield the contents of a file in chunks without loading it into memory."""
+    async with aiofiles.open(file_path, 'rb') as f:
+        while chunk := await f.read(chunk_size):
+            yield chunk
+
+def load_etag_cache(cache_file):
+    """Load the download cache, keyed by source URL."""
+    if not os.path.exists(cache_file):
+        return {}
+    
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Ignoring unreadable cache file '{cache_file}': {e}")
+        return {}
+
+def save_etag_cache(cache_file, cache):
+    """Write the download cache, replacing the previous file atomically."""
+    temp_cache_file = f"{cache_file}.tmp"
+    with open(temp_cache_file, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(temp_cache_file, cache_file)
+
+# Map extensions to standardized types
+FILE_TYPES = {
+    'pdf': 'pdf',
+    'doc': 'docx',
+    'docx': 'docx',
+    'ppt': 'pptx',
+    'pptx': 'pptx',
+    'xls': 'xlsx',
+    'xlsx': 'xlsx',
+}
 
 def get_file_type(filename):
     """Get the file type from the filename extension."""
     ext = Path(filename).suffix.lower().lstrip('.')
-    
-    # Map extensions to standardized types
-    if ext in ['pdf']:
-        return 'pdf'
-    elif ext in ['doc', 'docx']:
-        return 'docx'
-    elif ext in ['ppt', 'pptx']:
-        return 'pptx'
-    elif ext in ['xls', 'xlsx']:
-        return 'xlsx'
-    else:
-        return ext
+    return FILE_TYPES.get(ext, ext)
+
+@lru_cache(maxsize=64)
+def _guess_mimetype(ext):
+    """Guess the mimetype for an extension, caching the result."""
+    mimetype, _ = mimetypes.guess_type(f"file{ext}")
+    return mimetype
 
-def upload_to_supabase(file_path, filename, metadata=None):
-    """Upload a file to Supabase storage and add metadata to the database."""
+def get_mimetype(filename):
+    """Get the mimetype of a file from its extension."""
+    return _guess_mimetype(Path(filename).suffix.lower())
+
+async def upload_to_supabase(session, body, filename, file_size, metadata=None, sha256=None):
+    """Upload a file body (an async iterator of chunks) to Supabase storage and return its database record."""
     try:
         # Generate a unique ID for the document
         document_id = str(uuid.uuid4())
@@ -209,23 +656,18 @@ def upload_to_supabase(file_path, filename, metadata=None):
         # Get file type from extension
         file_type = get_file_type(filename)
         
-        # Get file size
-        file_size = os.path.getsize(file_path)
-        
         # Get mimetype
-        mimetype, _ = mimetypes.guess_type(filename)
+        mimetype = get_mimetype(filename)
         
-        # Read file content
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-        
-        # Upload file to Supabase storage
+        # Upload file to Supabase storage, streaming the body
         storage_path = f"{document_id}/{filename}"
-        result = supabase_upload_file(
+        result = await supabase_upload_file(
+            session,
             'documents',
             storage_path,
-            file_content,
-            mimetype or "application/octet-stream"
+            body,
+            mimetype or "application/octet-stream",
+            file_size
         )
         
         if not result or not result.get('Key'):
@@ -243,10 +685,11 @@ def upload_to_supabase(file_path, filename, metadata=None):
             "last_modified": metadata.get('date') if metadata else now,
             "file_type": file_type,
             "source_url": metadata.get('url') if metadata else None,
+            "sha256": sha256,
         }
         
-        # Insert document metadata into database
-        db_result = supabase_insert_record('documents', {
+        # The record is inserted later together with other documents
+        return {
             "id": document_id,
             "filename": filename,
             "filetype": file_type,
@@ -257,103 +700,415 @@ def upload_to_supabase(file_path, filename, metadata=None):
             "upload_date": doc_metadata['upload_date'],
             "last_modified": doc_metadata['last_modified'],
             "metadata": doc_metadata,
-        })
-        
-        if not db_result:
-            print(f"Error adding {filename} metadata to database")
-            return None
-        
-        print(f"Successfully uploaded {filename} (ID: {document_id})")
-        return document_id
+        }
     
     except Exception as e:
         print(f"Error processing {filename}: {str(e)}")
         return None
 
-def main():
-    """Main function to process Excel file and upload documents."""
-    args = parse_arguments()
+def get_wanted_columns(args):
+    """Return the Excel columns the script reads, link column first."""
+    return [
+        column for column in (
+            args.column, args.name_column, args.type_column, args.author_column, args.date_column
+        ) if column
+    ]
+
+def read_excel_rows(args):
+    """Open the selected sheet without loading it into memory.
     
-    # Check if Excel file exists
-    if not os.path.exists(args.excel_file):
-        print(f"Error: Excel file '{args.excel_file}' not found.")
-        sys.exit(1)
+    Returns the sheet's column names, its number of data rows (None if
+    unknown) and an iterator of (row_number, row) pairs.
+    """
+    wanted_columns = get_wanted_columns(args)
+    
+    if Path(args.excel_file).suffix.lower() == '.xls':
+        # openpyxl cannot read the legacy .xls format, so fall back to pandas,
+        # parsing only the columns we use
+        df = pd.read_excel(
+            args.excel_file,
+            sheet_name=args.sheet,
+            usecols=lambda column: column in wanted_columns,
+            dtype={args.column: 'string'},
+        )
+        
+        # Parse the whole date column in one call; cells that can't be parsed
+        # keep their original value
+        if args.date_column and args.date_column in df.columns:
+            raw_dates = df[args.date_column]
+            parsed_dates = pd.to_datetime(raw_dates, errors='coerce')
+            df[args.date_column] = parsed_dates.astype(object).where(parsed_dates.notna(), raw_dates)
+        
+        # Plain tuples avoid building a Series per row, and positional lookup
+        # works for column names that aren't valid attribute names
+        column_indexes = {column: index for index, column in enumerate(df.columns)}
+        rows = (
+            (row_number, {column: values[index] for column, index in column_indexes.items()})
+            for row_number, values in enumerate(df.itertuples(index=False, name=None), start=1)
+        )
+        return list(df.columns), len(df), rows
+    
+    wb = load_workbook(args.excel_file, read_only=True, data_only=True)
+    sheet = args.sheet
+    if sheet not in wb.sheetnames and str(sheet).isdigit():
+        sheet = int(sheet)
+    ws = wb[sheet] if isinstance(sheet, str) else wb.worksheets[sheet]
+    
+    header = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+    columns = [column for column in header if column is not None]
+    
+    # Only keep the cells of the columns we actually use
+    column_indexes = {}
+    for index, column in enumerate(header):
+        if column in wanted_columns:
+            column_indexes.setdefault(column, index)
+    
+    link_index = column_indexes.get(args.column)
+    
+    def rows():
+        try:
+            for row_number, values in enumerate(ws.iter_rows(min_row=2, values_only=True), start=1):
+                # Most link sheets have many blank rows; drop them before
+                # picking out any other cells
+                link = values[link_index] if link_index is not None and link_index < len(values) else None
+                if not isinstance(link, str) or not link.strip():
+                    continue
+                
+                yield row_number, {
+                    column: values[index] if index < len(values) else None
+                    for column, index in column_indexes.items()
+                }
+        finally:
+            wb.close()
+    
+    total = ws.max_row - 1 if ws.max_row else None
+    return columns, total, rows()
+
+def build_metadata(row, columns, args):
+    """Gather document metadata from the optional Excel columns of a row."""
+    metadata = {
+        'url': row[args.column]
+    }
+    
+    if args.name_column and args.name_column in columns:
+        metadata['name'] = row[args.name_column]
+    
+    if args.author_column and args.author_column in columns:
+        metadata['author'] = row[args.author_column]
+    
+    if args.date_column and args.date_column in columns:
+        date_value = row[args.date_column]
+        if isinstance(date_value, (datetime, pd.Timestamp)):
+            metadata['date'] = date_value.isoformat()
+        elif isinstance(date_value, str):
+            try:
+                # Try to parse date string
+                parsed_date = pd.to_datetime(date_value)
+                metadata['date'] = parsed_date.isoformat()
+            except:
+                metadata['date'] = date_value
+    
+    if args.type_column and args.type_column in columns:
+        metadata['type'] = row[args.type_column]
+    
+    return metadata
+
+def remember_download(etag_cache, url, download, storage_path, document_id):
+    """Store a download's validators so the next run can skip the file."""
+    if download['etag'] or download['last_modified']:
+        etag_cache[url] = {
+            'etag': download['etag'],
+            'last_modified': download['last_modified'],
+            'storage_path': storage_path,
+            'document_id': document_id,
+        }
+
+async def find_duplicate(session, sha256, pending_records, known_hashes, etag_cache, stats):
+    """Return the id and storage path of a document with the same content, if any.
+    
+    Otherwise the hash is reserved for the caller, so copies found meanwhile
+    wait for this document instead of being stored too. Only a document whose
+    record is in the database counts as a duplicate.
+    """
+    while sha256 in known_hashes:
+        uploaded, inserted = known_hashes[sha256]
+        
+        # Once the original is uploaded, insert its record now rather than
+        # waiting for a batch that may not fill up
+        if await uploaded and not inserted.done():
+            await flush_records(session, pending_records, known_hashes, etag_cache, stats)
+        
+        duplicate = await inserted
+        if duplicate:
+            return duplicate
+    
+    loop = asyncio.get_running_loop()
+    known_hashes[sha256] = (loop.create_future(), loop.create_future())
+    
+    duplicate = await supabase_find_record(
+        session, 'documents', {'metadata->>sha256': f'eq.{sha256}'}, select='id,storage_path'
+    )
+    if duplicate:
+        settle_hash(known_hashes, sha256, duplicate)
+    
+    return duplicate
+
+def settle_hash(known_hashes, sha256, document):
+    """Resolve a hash reserved by find_duplicate(), or release it if document is None.
+    
+    A document is only passed once its record is in the database. Only the
+    task holding the reservation may settle it.
+    """
+    uploaded, inserted = known_hashes[sha256]
+    if document is None:
+        del known_hashes[sha256]
+    
+    if not uploaded.done():
+        uploaded.set_result(document is not None)
+    inserted.set_result(document)
+
+async def flush_records(session, pending_records, known_hashes, etag_cache, stats):
+    """Insert all pending document records into the database in one request."""
+    batch = pending_records[:]
+    pending_records.clear()
+    
+    if not batch:
+        return
+    
+    if await supabase_insert_records(session, 'documents', [record for record, _ in batch]):
+        inserted = batch
+    else:
+        # One bad record fails the whole statement, so retry them one at a
+        # time and only give up on the documents that still fail
+        print(f"Error adding metadata for {len(batch)} documents to database, retrying one by one")
+        inserted = []
+        for record, download in batch:
+            if await supabase_insert_records(session, 'documents', [record]):
+                inserted.append((record, download))
+                continue
+            
+            print(f"Error adding metadata for {record['filename']} to database")
+            stats['failed'] += 1
+            settle_hash(known_hashes, record['metadata']['sha256'], None)
+            
+            # Don't leave a file in storage that no record points to
+            await supabase_delete_file(session, 'documents', record['storage_path'])
+    
+    for record, download in inserted:
+        print(f"Successfully uploaded {record['filename']} (ID: {record['id']})")
+        stats['successful'] += 1
+        settle_hash(known_hashes, record['metadata']['sha256'], {
+            'id': record['id'],
+            'storage_path': record['storage_path'],
+        })
+        remember_download(
+            etag_cache, record['metadata']['source_url'], download, record['storage_path'], record['id']
+        )
+
+async def add_pending_record(session, record, download, pending_records, known_hashes, etag_cache, stats):
+    """Queue an uploaded document's record, inserting the batch once it is full.
+    
+    The caller must hold the reservation for the document's hash; a missing
+    record (a failed upload) releases it.
+    """
+    if not record:
+        settle_hash(known_hashes, download['sha256'], None)
+        stats['failed'] += 1
+        return
+    
+    pending_records.append((record, download))
+    
+    # Copies waiting on this document may now flush its record
+    uploaded, _ = known_hashes[record['metadata']['sha256']]
+    uploaded.set_result(True)
+    
+    if len(pending_records) >= INSERT_BATCH_SIZE:
+        await flush_records(session, pending_records, known_hashes, etag_cache, stats)
+
+async def downloader(session, download_queue, upload_queue, temp_dir, pending_records, known_hashes, etag_cache, stats):
+    """Download queued documents, handing files staged on disk to the uploaders."""
+    while (job := await download_queue.get()) is not None:
+        row_number, total, url, metadata = job
+        print(f"\nProcessing document {row_number}/{total}: {url}")
+        
+        cache_entry = etag_cache.get(url)
+        
+        # URLs this machine hasn't uploaded before may still have been
+        # imported elsewhere; check the catalog before spending bandwidth.
+        # Cached URLs are re-checked with conditional requests instead, so
+        # changed files still get uploaded again.
+        if not cache_entry:
+            existing = await supabase_count_records(session, 'documents', {'metadata->>source_url': f'eq.{url}'})
+            if existing:
+                print(f"Skipping {url}: already in the database")
+                stats['existing'] += 1
+                continue
+        
+        # Download the file
+        download = await download_file(session, url, temp_dir, cache_entry, metadata)
+        
+        if not download:
+            print(f"Skipping {url} due to download error")
+            stats['failed'] += 1
+            continue
+        
+        if download.get('not_modified'):
+            print(f"Skipping {url}: unchanged since last upload (ID: {cache_entry['document_id']})")
+            stats['unchanged'] += 1
+            continue
+        
+        if 'record' in download:
+            # Already streamed straight into storage, so a copy of a known
+            # document has to be deleted again instead of being skipped. The
+            # original's record is in the database by the time it's found.
+            record = download['record']
+            if not record:
+                # The upload failed before its hash was looked up, so this
+                # copy holds no reservation that needs releasing
+                stats['failed'] += 1
+                continue
+            
+            duplicate = await find_duplicate(session, download['sha256'], pending_records, known_hashes, etag_cache, stats)
+            if duplicate:
+                print(f"Skipping {download['filename']}: identical to existing document (ID: {duplicate['id']})")
+                stats['duplicates'] += 1
+                remember_download(etag_cache, url, download, duplicate['storage_path'], duplicate['id'])
+                await supabase_delete_file(session, 'documents', record['storage_path'])
+                continue
+            
+            await add_pending_record(session, record, download, pending_records, known_hashes, etag_cache, stats)
+            continue
+        
+        # Wait here if the uploaders are behind
+        await upload_queue.put((download, metadata))
+
+async def uploader(session, upload_queue, pending_records, known_hashes, etag_cache, stats):
+    """Upload downloaded documents to Supabase as they become available."""
+    while (item := await upload_queue.get()) is not None:
+        download, metadata = item
+        
+        try:
+            # Skip the upload if the same content is already stored
+            duplicate = await find_duplicate(session, download['sha256'], pending_records, known_hashes, etag_cache, stats)
+            
+            if duplicate:
+                print(f"Skipping {download['filename']}: identical to existing document (ID: {duplicate['id']})")
+                stats['duplicates'] += 1
+                remember_download(etag_cache, metadata['url'], download, duplicate['storage_path'], duplicate['id'])
+                continue
+            
+            # Upload to Supabase
+            record = await upload_to_supabase(
+                session,
+                read_file_chunks(download['path']),
+                download['filename'],
+                download['size'],
+                metadata,
+                download['sha256']
+            )
+        finally:
+            # Free the disk space as soon as the file is no longer needed
+            await asyncio.to_thread(shutil.rmtree, os.path.dirname(download['path']), ignore_errors=True)
+        
+        await add_pending_record(session, record, download, pending_records, known_hashes, etag_cache, stats)
+
+async def main_async(args):
+    """Process the Excel file and upload documents concurrently."""
+    # aiofiles and asyncio.to_thread() run on the loop's default executor
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=IO_THREADS))
     
     try:
         # Read Excel file
         print(f"Reading Excel file: {args.excel_file}")
-        df = pd.read_excel(args.excel_file, sheet_name=args.sheet)
+        columns, total, rows = await asyncio.to_thread(read_excel_rows, args)
         
         # Check if link column exists
-        if args.column not in df.columns:
+        if args.column not in columns:
             print(f"Error: Column '{args.column}' not found in Excel file.")
-            print(f"Available columns: {', '.join(df.columns)}")
+            print(f"Available columns: {', '.join(map(str, columns))}")
             sys.exit(1)
         
         # Create temporary directory for downloads
         with tempfile.TemporaryDirectory() as temp_dir:
             print(f"Created temporary directory: {temp_dir}")
             
-            # Process each row in the Excel file
-            successful_uploads = 0
-            failed_uploads = 0
+            download_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+            upload_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+            stats = {'successful': 0, 'failed': 0, 'unchanged': 0, 'duplicates': 0, 'existing': 0}
+            etag_cache = load_etag_cache(args.cache_file)
             
-            for index, row in df.iterrows():
-                url = row[args.column]
-                
-                # Skip empty URLs
-                if pd.isna(url) or not url.strip():
-                    continue
-                
-                print(f"\nProcessing document {index+1}/{len(df)}: {url}")
-                
-                # Gather metadata from other columns if provided
-                metadata = {
-                    'url': url
-                }
-                
-                if args.name_column and args.name_column in df.columns:
-                    metadata['name'] = row[args.name_column]
-                
-                if args.author_column and args.author_column in df.columns:
-                    metadata['author'] = row[args.author_column]
-                
-                if args.date_column and args.date_column in df.columns:
-                    date_value = row[args.date_column]
-                    if isinstance(date_value, (datetime, pd.Timestamp)):
-                        metadata['date'] = date_value.isoformat()
-                    elif isinstance(date_value, str):
-                        try:
-                            # Try to parse date string
-                            parsed_date = pd.to_datetime(date_value)
-                            metadata['date'] = parsed_date.isoformat()
-                        except:
-                            metadata['date'] = date_value
-                
-                if args.type_column and args.type_column in df.columns:
-                    metadata['type'] = row[args.type_column]
-                
-                # Download the file
-                temp_file_path, filename = download_file(url, temp_dir)
-                
-                if not temp_file_path:
-                    print(f"Skipping {url} due to download error")
-                    failed_uploads += 1
-                    continue
+            # Uploaded documents whose database records have not been
+            # inserted yet, and the documents stored during this run by
+            # content hash (see find_duplicate())
+            pending_records = []
+            known_hashes = {}
+            
+            async def feed_rows():
+                # Process each row in the Excel file; the bar tracks how far
+                # through the sheet the pipeline has got, blank rows included
+                with tqdm(total=total, desc='Rows', unit='row') as bar:
+                    # The rows are parsed lazily, so pull them in batches on
+                    # the thread pool rather than on the event loop
+                    while batch := await asyncio.to_thread(list, itertools.islice(rows, ROW_BATCH_SIZE)):
+                        for row_number, row in batch:
+                            bar.update(row_number - bar.n)
+                            url = row[args.column]
+                            
+                            # Skip empty URLs
+                            if not isinstance(url, str) or not url.strip():
+                                continue
+                            
+                            metadata = build_metadata(row, columns, args)
+                            await download_queue.put((row_number, total or '?', url, metadata))
+                    
+                    if total:
+                        bar.update(total - bar.n)
                 
-                # Upload to Supabase
-                document_id = upload_to_supabase(temp_file_path, filename, metadata)
+                for _ in range(DOWNLOAD_WORKERS):
+                    await download_queue.put(None)
+            
+            async def run_downloaders():
+                await asyncio.gather(*(
+                    downloader(
+                        session, download_queue, upload_queue, temp_dir,
+                        pending_records, known_hashes, etag_cache, stats
+                    )
+                    for _ in range(DOWNLOAD_WORKERS)
+                ))
                 
-                if document_id:
-                    successful_uploads += 1
-                else:
-                    failed_uploads += 1
+                for _ in range(UPLOAD_WORKERS):
+                    await upload_queue.put(None)
+            
+            try:
+                async with create_session() as session:
+                    try:
+                        await asyncio.gather(
+                            feed_rows(),
+                            run_downloaders(),
+                            *(
+                                uploader(session, upload_queue, pending_records, known_hashes, etag_cache, stats)
+                                for _ in range(UPLOAD_WORKERS)
+                            )
+                        )
+                    finally:
+                        # Insert the records still waiting for a full batch
+                        await flush_records(session, pending_records, known_hashes, etag_cache, stats)
+            finally:
+                # Keep whatever was uploaded, even if the run was interrupted
+                save_etag_cache(args.cache_file, etag_cache)
+            
+            successful_uploads = stats['successful']
+            failed_uploads = stats['failed']
             
             # Print summary
             print("\n" + "="*50)
             print(f"Upload Summary:")
-            print(f"  Total documents processed: {successful_uploads + failed_uploads}")
+            skipped = stats['unchanged'] + stats['duplicates'] + stats['existing']
+            print(f"  Total documents processed: {successful_uploads + failed_uploads + skipped}")
             print(f"  Successfully uploaded: {successful_uploads}")
+            print(f"  Already in database (skipped): {stats['existing']}")
+            print(f"  Unchanged (skipped): {stats['unchanged']}")
+            print(f"  Duplicates (skipped): {stats['duplicates']}")
             print(f"  Failed uploads: {failed_uploads}")
             print("="*50)
             
@@ -361,5 +1116,16 @@ def main():
         print(f"Error processing Excel file: {str(e)}")
         sys.exit(1)
 
+def main():
+    """Main function to process Excel file and upload documents."""
+    args = parse_arguments()
+    
+    # Check if Excel file exists
+    if not os.path.exists(args.excel_file):
+        print(f"Error: Excel file '{args.excel_file}' not found.")
+        sys.exit(1)
+    
+    asyncio.run(main_async(args))
+
 if __name__ == "__main__":
     main()